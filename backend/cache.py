@@ -0,0 +1,176 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+class SemanticCache:
+    """
+    Cache of assistant answers keyed on the embedding of the user question.
+
+    A lookup returns a cached answer when the cosine similarity between the
+    question and a previously answered one exceeds the threshold. Entries are
+    evicted least-recently-used first and expire after a fixed TTL.
+
+    Embeddings are stored int8-quantized with a per-vector scale, a quarter
+    of the memory of float32, and similarities are accumulated in int32.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 256, ttl: float = 300.0):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # key -> ((quantized embedding, scale), answer, source documents, created at)
+        self._entries = OrderedDict()
+        self._next_key = 0
+
+        # Stacked embeddings for a single matrix-vector product, rebuilt lazily
+        self._keys: List[int] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _quantize(embedding: Sequence[float]) -> Tuple[np.ndarray, float]:
+        # Normalize, then map symmetrically onto [-127, 127]
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        return np.round(vector / scale).astype(np.int8), scale
+
+    def lookup(self, embedding: Sequence[float]) -> Optional[Tuple[str, List[Any]]]:
+        """
+        Find a cached answer for a question embedding.
+
+        Args:
+            embedding: Embedding of the user question
+
+        Returns:
+            Tuple of (answer, source documents), or None on a miss
+        """
+        query, query_scale = self._quantize(embedding)
+
+        with self._lock:
+            self._evict_expired()
+            if not self._entries:
+                return None
+
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.stack([self._entries[key][0][0] for key in self._keys])
+                self._scales = np.array([self._entries[key][0][1] for key in self._keys], dtype=np.float32)
+
+            dots = np.einsum("ij,j->i", self._matrix, query, dtype=np.int32)
+            similarities = dots * self._scales * query_scale
+            best = int(np.argmax(similarities))
+            if similarities[best] <= self.threshold:
+                return None
+
+            key = self._keys[best]
+            self._entries.move_to_end(key)
+            _, answer, source_documents, _ = self._entries[key]
+            return answer, source_documents
+
+    def add(self, embedding: Sequence[float], answer: str, source_documents: Optional[List[Any]] = None):
+        """
+        Store an answer for a question embedding.
+
+        Args:
+            embedding: Embedding of the user question
+            answer: Assistant answer
+            source_documents: Documents the answer was generated from
+        """
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            self._entries[key] = (
+                self._quantize(embedding),
+                answer,
+                list(source_documents or []),
+                time.monotonic()
+            )
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            self._matrix = None
+
+    def clear(self):
+        """Drop all cached answers."""
+        with self._lock:
+            self._entries.clear()
+            self._keys = []
+            self._matrix = None
+
+    def _evict_expired(self):
+        cutoff = time.monotonic() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry[3] < cutoff]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that memoizes query embeddings in an LRU cache.
+
+    The semantic cache lookup and the retriever both embed the question, and
+    the condense-question step often leaves it unchanged, so repeated query
+    text is only sent to the embeddings API once.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_entries: int = 1024):
+        self.embeddings = embeddings
+        self.max_entries = max_entries
+
+        # sha256 of the query text -> embedding
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+            return embedding
+
+    def _put(self, key: str, embedding: List[float]):
+        with self._lock:
+            self._entries[key] = embedding
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        embedding = self._get(key)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(text)
+            self._put(key, embedding)
+        return embedding
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        embedding = self._get(key)
+        if embedding is None:
+            embedding = await self.embeddings.aembed_query(text)
+            self._put(key, embedding)
+        return embedding
@@ -1,18 +1,52 @@
-import uuid
 import asyncio
-import threading
+import secrets
 from datetime import datetime
-from typing import Dict, List, AsyncGenerator, Any
+from typing import Dict, List, AsyncGenerator, Any, Optional
 import json
 import os
+import time
+from contextlib import contextmanager
 
+import aiofiles
+from cachetools import TTLCache
 from langchain.chat_models import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.memory import ConversationSummaryBufferMemory
 from langchain.chains import ConversationalRetrievalChain
+from langchain.prompts import ChatPromptTemplate
 from langchain.vectorstores import Chroma
 from langchain.embeddings import OpenAIEmbeddings
 
 from models import ChatMessage
+from cache import SemanticCache, CachedEmbeddings
+from vector_store import CHROMA_PATH, get_chroma_client
+from executors import chat_pool, ingest_pool
+
+# Documents passed to the LLM, and candidates fetched for MMR reranking
+RETRIEVER_K = 5
+RETRIEVER_FETCH_K = 50
+
+# Prompt tokens of chat history kept verbatim before older turns are summarized
+MEMORY_MAX_TOKENS = 2000
+
+# Prompt for rewriting follow-up questions, in the same order as LangChain's
+# default: fixed instructions, then the growing chat history, then the question
+CONDENSE_QUESTION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Given the following conversation and a follow up question, rephrase the follow up question to be a standalone question, in its original language."),
+    ("human", "Chat History:\n{chat_history}"),
+    ("human", "Follow Up Input: {question}\nStandalone question:")
+])
+
+# Chats kept in memory, and seconds an idle chat stays loaded
+MAX_ACTIVE_CHATS = 1000
+ACTIVE_CHAT_TTL = 3600
+
+# Assets whose vector store and answer cache stay loaded without active chats
+MAX_LOADED_ASSETS = 100
+
+# Chat history files untouched for this many days are deleted, checked every interval
+HISTORY_RETENTION_DAYS = 30
+HISTORY_GC_INTERVAL = 6 * 3600
 
 class ChatService:
     def __init__(self):
@@ -20,16 +54,26 @@ class ChatService:
         if not openai_api_key:
             raise ValueError("OPENAI_API_KEY environment variable is not set")
         
-        # Initialize embedding model with OpenAI
-        self.embedding_model = OpenAIEmbeddings(openai_api_key=openai_api_key)
+        self.openai_api_key = openai_api_key
+        
+        # Initialize embedding model with OpenAI; repeated queries are served from memory
+        self.embedding_model = CachedEmbeddings(OpenAIEmbeddings(openai_api_key=openai_api_key))
         
         self.llm = ChatOpenAI(temperature=0.7, openai_api_key=openai_api_key)
         
-        # Store active chats
-        self.active_chats = {}
+        # Store active chats; idle chats are evicted and restored from disk on next use
+        self.active_chats = TTLCache(maxsize=MAX_ACTIVE_CHATS, ttl=ACTIVE_CHAT_TTL)
         
-        # Create locks for each chat thread
-        self.chat_locks = {}
+        # Chats with a turn in flight, kept reachable even if evicted above
+        self._busy_chats: Dict[str, Dict[str, Any]] = {}
+        
+        # Semantic answer caches, shared by all chats on the same asset
+        self.semantic_caches = TTLCache(maxsize=MAX_LOADED_ASSETS, ttl=ACTIVE_CHAT_TTL)
+        
+        # Loaded vector stores, shared by all chats on the same asset; an
+        # asset's entries expire once none of its chats has been used for the TTL
+        self._vectorstore_cache = TTLCache(maxsize=MAX_LOADED_ASSETS, ttl=ACTIVE_CHAT_TTL)
+        self._vectorstore_loads: Dict[str, asyncio.Future] = {}
         
         # Create directory for chat history
         os.makedirs("./chat_history", exist_ok=True)
@@ -45,46 +89,201 @@ class ChatService:
             Chat thread ID
         """
         # Generate a unique chat thread ID
-        chat_thread_id = str(uuid.uuid4())
+        chat_thread_id = secrets.token_hex(16)
         
-        # Create a lock for this chat thread
-        self.chat_locks[chat_thread_id] = threading.Lock()
+        self.active_chats[chat_thread_id] = await self._build_chat(chat_thread_id, asset_id, [])
         
-        # Load the vector store for the asset
-        def load_vectorstore():
-            vectorstore = Chroma(
-                persist_directory=f"./chroma_db/{asset_id}",
-                embedding_function=self.embedding_model
-            )
-            
-            # Create conversation memory
-            memory = ConversationBufferMemory(
-                memory_key='chat_history',
-                return_messages=True
-            )
-            
-            # Create conversation chain with OpenAI
-            conversation_chain = ConversationalRetrievalChain.from_llm(
-                llm=self.llm,
-                retriever=vectorstore.as_retriever(),
-                memory=memory
-            )
+        # Remember the asset so the chat can be restored after eviction
+        async with aiofiles.open(f"./chat_history/{chat_thread_id}.meta.json", 'w') as f:
+            await f.write(json.dumps({"asset_id": asset_id}))
+        
+        return chat_thread_id
+    
+    async def _build_chat(self, chat_thread_id: str, asset_id: str, history: List[ChatMessage]) -> Dict[str, Any]:
+        """
+        Build the conversation chain and state for a chat thread.
+        
+        Args:
+            chat_thread_id: Chat thread ID
+            asset_id: Asset ID to associate with the chat
+            history: Previous messages of the chat
             
-            return conversation_chain
+        Returns:
+            Chat state for active_chats
+        """
+        # Route all of the chat's requests to the same OpenAI prompt cache
+        cache_kwargs = {"extra_body": {"prompt_cache_key": chat_thread_id}}
         
-        # Run in a thread pool to avoid blocking
-        loop = asyncio.get_event_loop()
-        conversation_chain = await loop.run_in_executor(None, load_vectorstore)
+        # Answers are streamed token by token through a handler set per turn;
+        # the condense-question step uses a non-streaming LLM so its tokens
+        # don't leak into the response
+        streaming_llm = ChatOpenAI(
+            temperature=0.7,
+            openai_api_key=self.openai_api_key,
+            streaming=True,
+            model_kwargs=cache_kwargs
+        )
+        condense_llm = ChatOpenAI(
+            temperature=0.7,
+            openai_api_key=self.openai_api_key,
+            model_kwargs=cache_kwargs
+        )
+        
+        vectorstore = await self._get_vectorstore(asset_id)
         
-        # Store the conversation chain and initialize chat history
-        self.active_chats[chat_thread_id] = {
+        # Create conversation memory; turns beyond the token budget are summarized
+        memory = ConversationSummaryBufferMemory(
+            llm=self.llm,
+            max_token_limit=MEMORY_MAX_TOKENS,
+            memory_key='chat_history',
+            output_key='answer',
+            return_messages=True
+        )
+        
+        if history:
+            # Replay restored history; pruning may summarize it with a blocking LLM call
+            for msg in history:
+                if msg.role == "user":
+                    memory.chat_memory.add_user_message(msg.content)
+                else:
+                    memory.chat_memory.add_ai_message(msg.content)
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(chat_pool, memory.prune)
+        
+        # Create conversation chain with OpenAI
+        conversation_chain = ConversationalRetrievalChain.from_llm(
+            llm=streaming_llm,
+            condense_question_llm=condense_llm,
+            condense_question_prompt=CONDENSE_QUESTION_PROMPT,
+            retriever=vectorstore.as_retriever(
+                search_type="mmr",
+                search_kwargs={"k": RETRIEVER_K, "fetch_k": RETRIEVER_FETCH_K}
+            ),
+            memory=memory,
+            return_source_documents=True
+        )
+        
+        return {
             "asset_id": asset_id,
             "conversation_chain": conversation_chain,
-            "history": [],
-            "processing": False  # Flag to track if a message is being processed
+            "vectorstore": vectorstore,
+            "streaming_llm": streaming_llm,
+            "sem_cache": self.semantic_caches.setdefault(asset_id, SemanticCache()),
+            "history": list(history),
+            "lock": asyncio.Lock()  # Held while a message is being processed
         }
+    
+    async def _get_chat(self, chat_thread_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get an active chat, restoring it from disk if it was evicted.
         
-        return chat_thread_id
+        Args:
+            chat_thread_id: Chat thread ID
+            
+        Returns:
+            Chat state, or None if the chat does not exist
+        """
+        chat = self._find_chat(chat_thread_id)
+        if chat is None:
+            meta_path = f"./chat_history/{chat_thread_id}.meta.json"
+            if not os.path.exists(meta_path):
+                return None
+            
+            async with aiofiles.open(meta_path, 'r') as f:
+                asset_id = json.loads(await f.read())["asset_id"]
+            history = await self._load_chat_history(chat_thread_id) or []
+            chat = await self._build_chat(chat_thread_id, asset_id, history)
+            
+            # Another request may have restored the chat in the meantime
+            chat = self._find_chat(chat_thread_id) or chat
+        
+        # Re-inserting restarts the TTL of the chat and of its asset's shared state
+        self.active_chats[chat_thread_id] = chat
+        asset_id = chat["asset_id"]
+        self._vectorstore_cache[asset_id] = self._vectorstore_cache.get(asset_id, chat["vectorstore"])
+        self.semantic_caches[asset_id] = self.semantic_caches.get(asset_id, chat["sem_cache"])
+        return chat
+    
+    def _find_chat(self, chat_thread_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a loaded chat without restoring it from disk.
+        
+        Args:
+            chat_thread_id: Chat thread ID
+            
+        Returns:
+            Chat state, or None if the chat is not loaded
+        """
+        chat = self.active_chats.get(chat_thread_id)
+        if chat is None:
+            chat = self._busy_chats.get(chat_thread_id)
+        return chat
+    
+    @contextmanager
+    def _pin_chat(self, chat_thread_id: str, chat: Dict[str, Any]):
+        """
+        Keep a chat reachable while a turn is running. Without this, a chat
+        evicted mid-turn would be restored with a new lock and memory,
+        allowing a second concurrent turn on the same thread.
+        
+        Args:
+            chat_thread_id: Chat thread ID
+            chat: Chat state
+        """
+        self._busy_chats[chat_thread_id] = chat
+        try:
+            yield
+        finally:
+            del self._busy_chats[chat_thread_id]
+            self.active_chats[chat_thread_id] = chat
+    
+    async def _get_vectorstore(self, asset_id: str) -> Chroma:
+        """
+        Get the vector store for an asset, loading it on first use.
+        
+        Args:
+            asset_id: Asset ID of the vector store
+            
+        Returns:
+            Chroma vector store shared by all chats on the asset
+        """
+        vectorstore = self._vectorstore_cache.get(asset_id)
+        if vectorstore is not None:
+            return vectorstore
+        
+        # Load the vector store for the asset
+        def load_vectorstore():
+            legacy_dir = os.path.join(CHROMA_PATH, asset_id)
+            if os.path.isdir(legacy_dir):
+                # Assets processed before collections moved to the shared client
+                return Chroma(
+                    persist_directory=legacy_dir,
+                    embedding_function=self.embedding_model
+                )
+            return Chroma(
+                client=get_chroma_client(),
+                collection_name=asset_id,
+                embedding_function=self.embedding_model
+            )
+        
+        # Chats on the same cold asset share one in-flight load, while other
+        # assets are not blocked by it
+        load = self._vectorstore_loads.get(asset_id)
+        if load is None:
+            # Run in a thread pool to avoid blocking
+            loop = asyncio.get_event_loop()
+            load = asyncio.ensure_future(loop.run_in_executor(chat_pool, load_vectorstore))
+            self._vectorstore_loads[asset_id] = load
+            
+            def on_loaded(future: asyncio.Future):
+                del self._vectorstore_loads[asset_id]
+                if not future.cancelled() and future.exception() is None:
+                    self._vectorstore_cache[asset_id] = future.result()
+            
+            load.add_done_callback(on_loaded)
+        
+        # Shielded so one cancelled caller doesn't cancel the load for the others
+        return await asyncio.shield(load)
     
     async def send_message(self, chat_thread_id: str, message: str) -> AsyncGenerator[str, None]:
         """
@@ -97,67 +296,81 @@ class ChatService:
         Yields:
             Tokens of the assistant's response
         """
-        if chat_thread_id not in self.active_chats:
+        chat = await self._get_chat(chat_thread_id)
+        if chat is None:
             raise ValueError(f"Chat thread {chat_thread_id} not found")
         
-        # Get the lock for this chat thread
-        chat_lock = self.chat_locks.get(chat_thread_id)
-        if not chat_lock:
-            chat_lock = threading.Lock()
-            self.chat_locks[chat_thread_id] = chat_lock
-        
-        if not chat_lock.acquire(blocking=False):
+        chat_lock = chat["lock"]
+        if chat_lock.locked():
             # If the lock is already held, it means another request is being processed
             yield "I'm still processing your previous message. Please wait a moment."
             return
         
-        try:
-            # Set the processing flag
-            self.active_chats[chat_thread_id]["processing"] = True
+        async with chat_lock:
+            with self._pin_chat(chat_thread_id, chat):
+                # Only the first turn is answered without chat context, so only it
+                # can safely share answers with other chats on the asset
+                standalone = not chat["history"]
             
-            # Add user message to history
-            timestamp = datetime.now().isoformat()
-            user_message = ChatMessage(role="user", content=message, timestamp=timestamp)
-            self.active_chats[chat_thread_id]["history"].append(user_message)
+                # Add user message to history; both messages of the turn share its timestamp
+                timestamp = datetime.now().isoformat()
+                user_message = ChatMessage(role="user", content=message, timestamp=timestamp)
+                chat["history"].append(user_message)
             
-            # Get conversation chain
-            conversation_chain = self.active_chats[chat_thread_id]["conversation_chain"]
+                # Get conversation chain
+                conversation_chain = chat["conversation_chain"]
             
-            # Process the message in a thread pool
-            def process_message():
-                return conversation_chain.invoke({"question": message})
+                # Answer from the semantic cache when a near-identical question was already asked
+                sem_cache = chat["sem_cache"]
+                cached = None
+                if standalone:
+                    query_embedding = await self.embedding_model.aembed_query(message)
+                    cached = sem_cache.lookup(query_embedding)
             
-            # Run in a thread pool to avoid blocking
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, process_message)
+                if cached:
+                    assistant_response, _ = cached
+                
+                    # Keep the conversation memory in step with the cached turn
+                    await conversation_chain.memory.asave_context(
+                        {"question": message},
+                        {"answer": assistant_response}
+                    )
+                    yield assistant_response
+                else:
+                    # A fresh handler per turn, so tokens and completion signals from an
+                    # interrupted turn still winding down can't end this one
+                    stream_handler = AsyncIteratorCallbackHandler()
+                    chat["streaming_llm"].callbacks = [stream_handler]
+                
+                    chain_task = asyncio.create_task(conversation_chain.ainvoke({"question": message}))
+                    # Stop waiting for tokens if the chain fails before the LLM starts
+                    chain_task.add_done_callback(lambda _: stream_handler.done.set())
+                
+                    # Stream tokens as the LLM generates them
+                    tokens = []
+                    try:
+                        async for token in stream_handler.aiter():
+                            tokens.append(token)
+                            yield token
+                        response = await chain_task
+                    finally:
+                        if not chain_task.done():
+                            chain_task.cancel()
+                
+                    assistant_response = "".join(tokens)
+                    if standalone and assistant_response:
+                        sem_cache.add(query_embedding, assistant_response, response.get('source_documents', []))
             
-            assistant_response = response['answer']
-            
-            # Add assistant message to history
-            assistant_message = ChatMessage(
-                role="assistant", 
-                content=assistant_response,
-                timestamp=datetime.now().isoformat()
-            )
-            self.active_chats[chat_thread_id]["history"].append(assistant_message)
+                # Add assistant message to history
+                assistant_message = ChatMessage(
+                    role="assistant", 
+                    content=assistant_response,
+                    timestamp=timestamp
+                )
+                chat["history"].append(assistant_message)
             
-            # Save chat history
-            await self._save_chat_history(chat_thread_id)
-            
-            print(f"Assistant response: {assistant_response}")
-            
-            # Stream the response word by word
-            words = assistant_response.split()
-            for i, word in enumerate(words):
-                yield word + " "
-                if i < len(words) - 1 and word.endswith(('.', '!', '?')):
-                    yield "\n"
-                await asyncio.sleep(0.05)  # Simulate streaming
-        
-        finally:
-            # Clear the processing flag and release the lock
-            self.active_chats[chat_thread_id]["processing"] = False
-            chat_lock.release()
+                # Append the new turn to the chat history on disk
+                await self._append_chat_history(chat_thread_id, [user_message, assistant_message])
     
     async def get_chat_history(self, chat_thread_id: str) -> List[ChatMessage]:
         """
@@ -169,16 +382,19 @@ class ChatService:
         Returns:
             List of chat messages
         """
-        if chat_thread_id not in self.active_chats:
+        chat = self._find_chat(chat_thread_id)
+        if chat is None:
             # Try to load from disk
-            history_path = f"./chat_history/{chat_thread_id}.json"
-            if os.path.exists(history_path):
-                with open(history_path, 'r') as f:
-                    history_data = json.load(f)
-                    return [ChatMessage(**msg) for msg in history_data]
+            history = await self._load_chat_history(chat_thread_id)
+            if history is not None:
+                return history
+            
+            # A chat that has not sent a message yet only has its meta file
+            if os.path.exists(f"./chat_history/{chat_thread_id}.meta.json"):
+                return []
             raise ValueError(f"Chat thread {chat_thread_id} not found")
         
-        return self.active_chats[chat_thread_id]["history"]
+        return chat["history"]
     
     async def is_processing(self, chat_thread_id: str) -> bool:
         """
@@ -190,20 +406,77 @@ class ChatService:
         Returns:
             True if processing, False otherwise
         """
-        if chat_thread_id not in self.active_chats:
+        chat = self._find_chat(chat_thread_id)
+        if chat is None:
             return False
         
-        return self.active_chats[chat_thread_id].get("processing", False)
+        return chat["lock"].locked()
+    
+    async def _append_chat_history(self, chat_thread_id: str, messages: List[ChatMessage]):
+        """
+        Append messages to the chat history on disk.
+        
+        Args:
+            chat_thread_id: Chat thread ID
+            messages: Messages to append
+        """
+        history_path = f"./chat_history/{chat_thread_id}.ndjson"
+        
+        async with aiofiles.open(history_path, 'a') as f:
+            await f.write("".join(json.dumps(msg.dict()) + "\n" for msg in messages))
     
-    async def _save_chat_history(self, chat_thread_id: str):
+    async def _load_chat_history(self, chat_thread_id: str) -> Optional[List[ChatMessage]]:
         """
-        Save chat history to disk.
+        Load chat history from disk.
         
         Args:
             chat_thread_id: Chat thread ID
+            
+        Returns:
+            List of chat messages, or None if no history was saved
         """
-        history = self.active_chats[chat_thread_id]["history"]
-        history_path = f"./chat_history/{chat_thread_id}.json"
+        history_path = f"./chat_history/{chat_thread_id}.ndjson"
+        if os.path.exists(history_path):
+            history = []
+            async with aiofiles.open(history_path, 'r') as f:
+                async for line in f:
+                    if line.strip():
+                        history.append(ChatMessage(**json.loads(line)))
+            return history
+        
+        # Chats saved before the switch to NDJSON
+        legacy_path = f"./chat_history/{chat_thread_id}.json"
+        if os.path.exists(legacy_path):
+            async with aiofiles.open(legacy_path, 'r') as f:
+                return [ChatMessage(**msg) for msg in json.loads(await f.read())]
         
-        with open(history_path, 'w') as f:
-            json.dump([msg.dict() for msg in history], f)
+        return None
+    
+    async def periodic_gc(self):
+        """
+        Delete chat history files that have not been written for HISTORY_RETENTION_DAYS.
+        Runs until cancelled.
+        """
+        def remove_stale_history():
+            cutoff = time.time() - HISTORY_RETENTION_DAYS * 86400
+            
+            # Group files by chat so a chat's files are deleted together
+            chats = {}
+            for entry in os.scandir("./chat_history"):
+                if entry.is_file():
+                    chat_thread_id = entry.name.split(".", 1)[0]
+                    paths, last_modified = chats.get(chat_thread_id, ([], 0))
+                    chats[chat_thread_id] = (paths + [entry.path], max(last_modified, entry.stat().st_mtime))
+            
+            for chat_thread_id, (paths, last_modified) in chats.items():
+                if last_modified < cutoff:
+                    for path in paths:
+                        os.remove(path)
+        
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(ingest_pool, remove_stale_history)
+            except OSError as e:
+                print(f"Error removing stale chat history: {str(e)}")
+            await asyncio.sleep(HISTORY_GC_INTERVAL)
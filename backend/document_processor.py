@@ -1,13 +1,44 @@
 import os
-import uuid
 import asyncio
-from typing import List, Dict, Any
-import chromadb
+import secrets
+import hashlib
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, AsyncIterator
+import numpy as np
+from langchain.schema import Document
 from langchain.document_loaders import TextLoader, PyPDFLoader, Docx2txtLoader
-from langchain.text_splitter import CharacterTextSplitter
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.vectorstores import Chroma
 
+from vector_store import get_chroma_client, hnsw_metadata
+from executors import ingest_pool
+from pdf_worker import count_pdf_pages, extract_pdf_pages
+
+# Chunk size and overlap, in tokens of the embedding model
+CHUNK_SIZE_TOKENS = 512
+CHUNK_OVERLAP_TOKENS = 64
+
+# Number of chunks sent to the embeddings API per request
+EMBEDDING_BATCH_SIZE = 512
+
+# Number of chunks written to Chroma per add call
+UPSERT_BATCH_SIZE = 256
+
+# Number of embedding requests in flight at once
+EMBEDDING_CONCURRENCY = 8
+
+# Number of PDF pages parsed by a worker process per task
+PDF_PAGES_PER_TASK = 4
+
+# PDF parsing worker processes
+PDF_WORKERS = min(4, os.cpu_count() or 1)
+
+# Maximum number of chunk embeddings kept for re-ingested text
+EMBEDDING_CACHE_SIZE = 4096
+
 class DocumentProcessor:
     def __init__(self):
         openai_api_key = os.environ.get("OPENAI_API_KEY")
@@ -16,9 +47,23 @@ class DocumentProcessor:
         
         self.embedding_model = OpenAIEmbeddings(openai_api_key=openai_api_key)
         
+        # Chunk embeddings keyed on the sha256 of the chunk text, stored as
+        # float32 arrays (a list of Python floats is about 8x larger)
+        self.embedding_cache = OrderedDict()
+        
+        # Dedicated pool for blocking loaders so they don't starve the default executor
+        self.io_executor = ingest_pool
+        
+        # PDF text extraction is pure-Python and CPU bound, so pages are parsed in
+        # worker processes. They are spawned rather than forked because this
+        # process already runs threads (thread pools, log listener, Chroma)
+        self.pdf_executor = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        
         # Initialize ChromaDB client
-        os.makedirs("./chroma_db", exist_ok=True)
-        self.chroma_client = chromadb.PersistentClient(path="./chroma_db")
+        self.chroma_client = get_chroma_client()
         
         # Supported file extensions
         self.supported_extensions = {
@@ -28,12 +73,13 @@ class DocumentProcessor:
             ".docx": Docx2txtLoader
         }
         
-    async def process_document(self, file_path: str) -> str:
+    async def process_document(self, file_path: str, profile: str = "balanced") -> str:
         """
         Process a document and create embeddings.
         
         Args:
             file_path: Path to the document file
+            profile: ANN search profile for the asset collection
             
         Returns:
             Asset ID for the processed document
@@ -70,14 +116,14 @@ class DocumentProcessor:
             raise ValueError(f"Unsupported file type: {ext}. Supported types: {list(self.supported_extensions.keys())}")
         
         # Generate a unique asset ID
-        asset_id = str(uuid.uuid4())
+        asset_id = secrets.token_hex(16)
         
         # Process the document asynchronously
-        await self._process_document_async(file_path, ext.lower(), asset_id)
+        await self._process_document_async(file_path, ext.lower(), asset_id, profile)
         
         return asset_id
     
-    async def _process_document_async(self, file_path: str, ext: str, asset_id: str):
+    async def _process_document_async(self, file_path: str, ext: str, asset_id: str, profile: str = "balanced"):
         """
         Process document asynchronously to create and store embeddings.
         
@@ -85,47 +131,173 @@ class DocumentProcessor:
             file_path: Path to the document
             ext: File extension
             asset_id: Unique asset ID
+            profile: ANN search profile for the asset collection
         """
-        # Use appropriate loader based on file extension
-        loader_class = self.supported_extensions[ext]
+        loop = asyncio.get_event_loop()
         
-        # Run document loading in a thread pool
-        def load_and_process():
-            try:
-                # Load document
-                loader = loader_class(file_path)
-                documents = loader.load()
-                
-                # Split text into chunks
-                text_splitter = CharacterTextSplitter(
-                    separator="\n",
-                    chunk_size=1000,
-                    chunk_overlap=200,
-                    length_function=len
-                )
-                text_chunks = text_splitter.split_documents(documents)
-                
-                # Create vector store with OpenAI embeddings
-                persist_dir = f"./chroma_db/{asset_id}"
-                os.makedirs(persist_dir, exist_ok=True)
-                
-                vectorstore = Chroma.from_documents(
-                    documents=text_chunks,
-                    embedding=self.embedding_model,
-                    persist_directory=persist_dir
+        # Split text into chunks measured in embedding model tokens
+        text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            model_name=self.embedding_model.model,
+            chunk_size=CHUNK_SIZE_TOKENS,
+            chunk_overlap=CHUNK_OVERLAP_TOKENS
+        )
+        
+        # Create a collection for the asset in the shared vector store
+        def create_vectorstore():
+            return Chroma(
+                client=self.chroma_client,
+                collection_name=asset_id,
+                embedding_function=self.embedding_model,
+                collection_metadata=hnsw_metadata(profile)
+            )
+        
+        vectorstore = await loop.run_in_executor(self.io_executor, create_vectorstore)
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        
+        async def embed_and_store(chunks: List[Document]):
+            texts = [chunk.page_content for chunk in chunks]
+            embeddings = await self._embed_texts(texts, semaphore)
+            
+            # Store the precomputed embeddings without embedding again, in
+            # slices so the batch becomes queryable as it is written
+            def store_embeddings():
+                for i in range(0, len(chunks), UPSERT_BATCH_SIZE):
+                    vectorstore._collection.add(
+                        ids=[secrets.token_hex(16) for _ in chunks[i:i + UPSERT_BATCH_SIZE]],
+                        embeddings=embeddings[i:i + UPSERT_BATCH_SIZE],
+                        documents=texts[i:i + UPSERT_BATCH_SIZE],
+                        metadatas=[chunk.metadata for chunk in chunks[i:i + UPSERT_BATCH_SIZE]]
+                    )
+            
+            # Chroma writes to disk synchronously; the persistent client needs no explicit persist
+            await loop.run_in_executor(self.io_executor, store_embeddings)
+        
+        # Embed and store chunks in batches while the remaining pages are still being parsed
+        pending_chunks = []
+        store_tasks = set()
+        chunk_count = 0
+        
+        async def submit(batch: List[Document]):
+            # Stop parsing while enough batches are in flight, so chunks and
+            # embeddings of a large document do not pile up in memory
+            nonlocal store_tasks
+            while len(store_tasks) >= EMBEDDING_CONCURRENCY:
+                done, store_tasks = await asyncio.wait(store_tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            store_tasks.add(asyncio.create_task(embed_and_store(batch)))
+        
+        try:
+            async for document in self._load_documents(file_path, ext):
+                # Token-measured splitting is CPU heavy, so keep it off the event loop
+                pending_chunks.extend(
+                    await loop.run_in_executor(self.io_executor, text_splitter.split_documents, [document])
                 )
-                
-                # Persist the vector store
-                vectorstore.persist()
-                
-                return len(text_chunks)
-            except Exception as e:
-                print(f"Error processing document: {str(e)}")
-                raise
-        
-        # Run in a thread pool to avoid blocking
-        loop = asyncio.get_event_loop()
-        chunk_count = await loop.run_in_executor(None, load_and_process)
+                while len(pending_chunks) >= EMBEDDING_BATCH_SIZE:
+                    batch = pending_chunks[:EMBEDDING_BATCH_SIZE]
+                    pending_chunks = pending_chunks[EMBEDDING_BATCH_SIZE:]
+                    await submit(batch)
+                    chunk_count += len(batch)
+            if pending_chunks:
+                await submit(pending_chunks)
+                chunk_count += len(pending_chunks)
+            
+            await asyncio.gather(*store_tasks)
+        except Exception as e:
+            for task in store_tasks:
+                task.cancel()
+            await asyncio.gather(*store_tasks, return_exceptions=True)
+            print(f"Error processing document: {str(e)}")
+            
+            # Drop the partially written collection so the asset is not left half indexed
+            try:
+                await loop.run_in_executor(self.io_executor, self.chroma_client.delete_collection, asset_id)
+            except Exception as cleanup_error:
+                print(f"Error deleting collection {asset_id}: {str(cleanup_error)}")
+            raise
         
         print(f"Processed document {file_path} with asset ID {asset_id}. Created {chunk_count} chunks.")
-
+    
+    async def _load_documents(self, file_path: str, ext: str) -> AsyncIterator[Document]:
+        """
+        Load a document, yielding PDF pages as soon as they are parsed.
+        
+        Args:
+            file_path: Path to the document
+            ext: File extension
+            
+        Yields:
+            Loaded documents, one per page for PDFs
+        """
+        loop = asyncio.get_event_loop()
+        
+        if ext != ".pdf":
+            # Use appropriate loader based on file extension
+            loader = self.supported_extensions[ext](file_path)
+            for document in await loop.run_in_executor(self.io_executor, loader.load):
+                yield document
+            return
+        
+        page_count = await loop.run_in_executor(self.io_executor, count_pdf_pages, file_path)
+        page_tasks = [
+            loop.run_in_executor(
+                self.pdf_executor,
+                extract_pdf_pages,
+                file_path,
+                start,
+                min(start + PDF_PAGES_PER_TASK, page_count)
+            )
+            for start in range(0, page_count, PDF_PAGES_PER_TASK)
+        ]
+        
+        for page_task in asyncio.as_completed(page_tasks):
+            for page_number, text in await page_task:
+                yield Document(page_content=text, metadata={"source": file_path, "page": page_number})
+    
+    async def _embed_texts(self, texts: List[str], semaphore: asyncio.Semaphore) -> List[List[float]]:
+        """
+        Embed texts in large batches, reusing cached embeddings for known text.
+        
+        Args:
+            texts: Texts to embed
+            semaphore: Bounds the number of embedding requests in flight
+            
+        Returns:
+            Embeddings in the same order as the texts
+        """
+        keys = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+        embeddings = [None] * len(texts)
+        
+        # Look up previously embedded chunks
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in self.embedding_cache:
+                self.embedding_cache.move_to_end(key)
+                embeddings[i] = self.embedding_cache[key].tolist()
+            else:
+                missing.setdefault(key, i)
+        
+        # Embed the remaining unique texts with overlapping batch requests
+        missing_keys = list(missing)
+        missing_texts = [texts[missing[key]] for key in missing_keys]
+        
+        async def embed_batch(batch: List[str]) -> List[List[float]]:
+            async with semaphore:
+                return await self.embedding_model.aembed_documents(batch)
+        
+        batch_results = await asyncio.gather(*[
+            embed_batch(missing_texts[i:i + EMBEDDING_BATCH_SIZE])
+            for i in range(0, len(missing_texts), EMBEDDING_BATCH_SIZE)
+        ])
+        new_embeddings = dict(zip(missing_keys, (vec for batch in batch_results for vec in batch)))
+        
+        for key, vec in new_embeddings.items():
+            self.embedding_cache[key] = np.asarray(vec, dtype=np.float32)
+        while len(self.embedding_cache) > EMBEDDING_CACHE_SIZE:
+            self.embedding_cache.popitem(last=False)
+        
+        for i, key in enumerate(keys):
+            if embeddings[i] is None:
+                embeddings[i] = new_embeddings[key]
+        
+        return embeddings
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+class MonitoredThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Thread pool that tracks how many jobs are queued and running.
+    """
+    
+    def __init__(self, max_workers: int, thread_name_prefix: str = ""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._stats_lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+    
+    def submit(self, fn, /, *args, **kwargs):
+        def run():
+            with self._stats_lock:
+                self._queued -= 1
+                self._active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self._active -= 1
+        
+        with self._stats_lock:
+            self._queued += 1
+        try:
+            return super().submit(run)
+        except Exception:
+            with self._stats_lock:
+                self._queued -= 1
+            raise
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the current load of the pool.
+        
+        Returns:
+            Queue depth, active threads and maximum workers
+        """
+        with self._stats_lock:
+            return {
+                "queued": self._queued,
+                "active": self._active,
+                "max_workers": self._max_workers
+            }
+
+# Document ingest (loaders, vector store writes); long-running jobs
+ingest_pool = MonitoredThreadPoolExecutor(max_workers=4, thread_name_prefix="ingest")
+
+# Chat setup; latency-critical, kept apart so ingest can't starve it
+chat_pool = MonitoredThreadPoolExecutor(max_workers=16, thread_name_prefix="chat")
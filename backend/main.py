@@ -4,6 +4,8 @@ from fastapi.responses import StreamingResponse
 import asyncio
 import os
 import logging
+import logging.handlers
+import queue
 import time
 from dotenv import load_dotenv
 
@@ -18,18 +20,38 @@ from models import (
 )
 from document_processor import DocumentProcessor
 from chat_service import ChatService
+from executors import ingest_pool, chat_pool
+
+# Configure logging; records are queued and written by a listener thread
+# so log I/O never blocks the event loop
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler = logging.FileHandler("app.log")
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+log_listener.start()
 
-# Configure logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("app.log"),
-        logging.StreamHandler()
-    ]
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
 logger = logging.getLogger("rag_chatbot")
 
+# SSE batching: the first frame is flushed immediately, later frames grow
+# by SSE_BATCH_GROWTH_FACTOR up to SSE_MAX_BATCH_SIZE characters, and
+# buffered tokens are never held longer than SSE_FLUSH_INTERVAL seconds
+SSE_MIN_BATCH_SIZE = 1
+SSE_BATCH_GROWTH_FACTOR = 3
+SSE_MAX_BATCH_SIZE = 8192
+SSE_FLUSH_INTERVAL = 0.025
+
+def format_sse(data: str) -> str:
+    """Format a payload as an SSE event, with one data field per line."""
+    return "".join(f"data: {line}\n" for line in data.split("\n")) + "\n"
+
 # Load environment variables
 logger.info("Loading environment variables")
 load_dotenv()
@@ -66,13 +88,13 @@ async def process_document(request: DocumentProcessRequest, background_tasks: Ba
     Returns:
         Document processing response with asset ID
     """
-    request_id = f"req_{int(time.time())}"
+    request_id = f"req_{time.time_ns()}"
     logger.info(f"[{request_id}] Processing document request for file: {request.file_path}")
     
     try:
         logger.info(f"[{request_id}] Calling document processor")
         start_time = time.time()
-        asset_id = await document_processor.process_document(request.file_path)
+        asset_id = await document_processor.process_document(request.file_path, request.profile)
         processing_time = time.time() - start_time
         
         logger.info(f"[{request_id}] Document processed successfully. Asset ID: {asset_id}. Processing time: {processing_time:.2f}s")
@@ -92,7 +114,7 @@ async def start_chat(request: ChatStartRequest):
     Returns:
         Chat start response with chat thread ID
     """
-    request_id = f"req_{int(time.time())}"
+    request_id = f"req_{time.time_ns()}"
     logger.info(f"[{request_id}] Starting chat with asset ID: {request.asset_id}")
     
     try:
@@ -118,7 +140,7 @@ async def send_message(request: ChatMessageRequest):
     Returns:
         Streaming response with agent's reply
     """
-    request_id = f"req_{int(time.time())}"
+    request_id = f"req_{time.time_ns()}"
     logger.info(f"[{request_id}] Sending message to chat thread: {request.chat_thread_id}")
     logger.info(f"[{request_id}] Message content: {request.message}")
     
@@ -128,10 +150,51 @@ async def send_message(request: ChatMessageRequest):
             token_count = 0
             start_time = time.time()
             
-            async for token in chat_service.send_message(request.chat_thread_id, request.message):
-                token_count += 1
-                yield f"data: {token}\n\n"
-                await asyncio.sleep(0.01)  # Small delay for streaming effect
+            buffer = []
+            buffered = 0
+            batch_size = SSE_MIN_BATCH_SIZE
+            last_flush = time.monotonic()
+            
+            tokens = chat_service.send_message(request.chat_thread_id, request.message).__aiter__()
+            next_token = None
+            
+            try:
+                while True:
+                    if next_token is None:
+                        next_token = asyncio.ensure_future(tokens.__anext__())
+                    
+                    # Wait for the next token, but only until buffered tokens are due,
+                    # so the tail of an answer isn't held back by post-processing
+                    timeout = None
+                    if buffer:
+                        timeout = max(0, SSE_FLUSH_INTERVAL - (time.monotonic() - last_flush))
+                    done, _ = await asyncio.wait({next_token}, timeout=timeout)
+                    
+                    if done:
+                        try:
+                            token = next_token.result()
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            next_token = None
+                        
+                        token_count += 1
+                        buffer.append(token)
+                        buffered += len(token)
+                        if buffered < batch_size and time.monotonic() - last_flush < SSE_FLUSH_INTERVAL:
+                            continue
+                    
+                    yield format_sse("".join(buffer))
+                    buffer = []
+                    buffered = 0
+                    batch_size = min(batch_size * SSE_BATCH_GROWTH_FACTOR, SSE_MAX_BATCH_SIZE)
+                    last_flush = time.monotonic()
+            finally:
+                if next_token is not None:
+                    next_token.cancel()
+            
+            if buffer:
+                yield format_sse("".join(buffer))
             
             processing_time = time.time() - start_time
             logger.info(f"[{request_id}] Response stream completed. Tokens: {token_count}. Processing time: {processing_time:.2f}s")
@@ -153,7 +216,7 @@ async def get_chat_history(chat_thread_id: str):
     Returns:
         Chat history response with messages
     """
-    request_id = f"req_{int(time.time())}"
+    request_id = f"req_{time.time_ns()}"
     logger.info(f"[{request_id}] Getting chat history for thread: {chat_thread_id}")
     
     try:
@@ -178,7 +241,7 @@ async def get_chat_status(chat_thread_id: str):
     Returns:
         Status of the chat thread
     """
-    request_id = f"req_{int(time.time())}"
+    request_id = f"req_{time.time_ns()}"
     logger.info(f"[{request_id}] Checking status for chat thread: {chat_thread_id}")
     
     try:
@@ -189,11 +252,30 @@ async def get_chat_status(chat_thread_id: str):
         logger.error(f"[{request_id}] Error checking chat status: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error checking chat status: {str(e)}")
 
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Get the load of the worker thread pools.
+    
+    Returns:
+        Queue depth and active threads per pool
+    """
+    return {
+        "ingest_pool": ingest_pool.stats(),
+        "chat_pool": chat_pool.stats()
+    }
+
 # Startup and shutdown events
 @app.on_event("startup")
 async def startup_event():
+    app.state.history_gc_task = asyncio.create_task(chat_service.periodic_gc())
     logger.info("Application startup complete")
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    logger.info("Application shutting down")
\ No newline at end of file
+    logger.info("Application shutting down")
+    app.state.history_gc_task.cancel()
+    ingest_pool.shutdown(wait=False)
+    chat_pool.shutdown(wait=False)
+    document_processor.pdf_executor.shutdown(wait=False)
+    log_listener.stop()
\ No newline at end of file
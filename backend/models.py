@@ -1,8 +1,9 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 class DocumentProcessRequest(BaseModel):
     file_path: str
+    profile: Literal["fast", "balanced", "recall"] = "balanced"  # ANN search profile
 
 class DocumentProcessResponse(BaseModel):
     asset_id: str
@@ -0,0 +1,23 @@
+from typing import List, Tuple
+
+from pypdf import PdfReader
+
+# Kept free of heavy imports: spawned worker processes import this module
+
+def count_pdf_pages(file_path: str) -> int:
+    return len(PdfReader(file_path).pages)
+
+def extract_pdf_pages(file_path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """
+    Extract the text of a range of PDF pages. Runs in a worker process.
+    
+    Args:
+        file_path: Path to the PDF
+        start: First page number
+        end: Page number after the last page
+        
+    Returns:
+        List of (page number, page text) tuples
+    """
+    reader = PdfReader(file_path)
+    return [(page_number, reader.pages[page_number].extract_text()) for page_number in range(start, end)]
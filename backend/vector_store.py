@@ -0,0 +1,48 @@
+import os
+import threading
+from typing import Any, Dict
+
+import chromadb
+
+CHROMA_PATH = "./chroma_db"
+
+# hnsw:search_ef for each ANN profile, trading query latency for recall
+ANN_PROFILES = {
+    "fast": 32,
+    "balanced": 128,
+    "recall": 256
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_chroma_client() -> chromadb.PersistentClient:
+    """
+    Get the persistent Chroma client shared by all asset collections.
+    
+    Returns:
+        Process-wide ChromaDB client
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            os.makedirs(CHROMA_PATH, exist_ok=True)
+            _client = chromadb.PersistentClient(path=CHROMA_PATH)
+        return _client
+
+def hnsw_metadata(profile: str = "balanced") -> Dict[str, Any]:
+    """
+    Get the HNSW index settings for a new asset collection.
+    
+    Args:
+        profile: ANN profile name, one of ANN_PROFILES
+        
+    Returns:
+        Collection metadata for Chroma
+    """
+    return {
+        "hnsw:space": "cosine",
+        "hnsw:M": 32,
+        "hnsw:construction_ef": 200,
+        "hnsw:search_ef": ANN_PROFILES[profile]
+    }
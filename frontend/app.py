@@ -2,7 +2,6 @@ import streamlit as st
 import requests
 import json
 import os
-import time
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -14,7 +13,18 @@ PROCESS_DOCUMENT_URL = f"{API_BASE_URL}/documents/process"
 START_CHAT_URL = f"{API_BASE_URL}/chat/start"
 SEND_MESSAGE_URL = f"{API_BASE_URL}/chat/message"
 GET_HISTORY_URL = f"{API_BASE_URL}/chat/history"
-GET_STATUS_URL = f"{API_BASE_URL}/chat/status"
+
+def stream_sse(response):
+    """Yield the data of each server-sent event as it arrives."""
+    event_lines = []
+    for line in response.iter_lines():
+        decoded_line = line.decode('utf-8')
+        if decoded_line.startswith('data: '):
+            event_lines.append(decoded_line[6:])
+        elif not decoded_line and event_lines:
+            # A blank line ends the event; its data lines are joined by newlines
+            yield "\n".join(event_lines)
+            event_lines = []
 
 # Set page config
 st.set_page_config(page_title="RAG Chatbot", layout="wide")
@@ -26,10 +36,6 @@ if "asset_id" not in st.session_state:
     st.session_state.asset_id = None
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "waiting_for_response" not in st.session_state:
-    st.session_state.waiting_for_response = False
-if "last_message_time" not in st.session_state:
-    st.session_state.last_message_time = None
 
 st.markdown("""
 <style>
@@ -151,14 +157,11 @@ with col2:
             else:
                 st.markdown(f'<div style="text-align: left;"><div class="assistant-message">{message["content"]}</div></div>', unsafe_allow_html=True)
         
-        if st.session_state.waiting_for_response:
-            st.markdown("⏳ Waiting for response...", unsafe_allow_html=True)
-        
         # Message input
         user_input = st.text_input("Type your message", key="message_input")
         send_button = st.button("Send")
         
-        if send_button and user_input and not st.session_state.waiting_for_response:
+        if send_button and user_input:
             # Add user message to the chat
             user_message = {
                 "role": "user",
@@ -166,12 +169,9 @@ with col2:
                 "timestamp": datetime.now().isoformat()
             }
             st.session_state.messages.append(user_message)
+            st.markdown(f'<div style="text-align: right;"><div class="user-message">{user_input}</div></div>', unsafe_allow_html=True)
             
-            # Set waiting flag
-            st.session_state.waiting_for_response = True
-            st.session_state.last_message_time = datetime.now().isoformat()
-            
-            # Make a non-blocking request to the API
+            # Stream the response into the chat as it is generated
             try:
                 response = requests.post(
                     SEND_MESSAGE_URL,
@@ -185,13 +185,11 @@ with col2:
                 
                 # Process the response
                 if response.status_code == 200:
-                    # Extract the response text
+                    response_placeholder = st.empty()
                     response_text = ""
-                    for line in response.iter_lines():
-                        if line:
-                            decoded_line = line.decode('utf-8')
-                            if decoded_line.startswith('data: '):
-                                response_text += decoded_line[6:] + " "
+                    for chunk in stream_sse(response):
+                        response_text += chunk
+                        response_placeholder.markdown(f'<div style="text-align: left;"><div class="assistant-message">{response_text}</div></div>', unsafe_allow_html=True)
                     
                     # Add assistant message to the chat
                     assistant_message = {
@@ -205,39 +203,8 @@ with col2:
             except Exception as e:
                 st.error(f"Error: {str(e)}")
             
-            # Clear the waiting flag
-            st.session_state.waiting_for_response = False
-            
-            # Rerun to update UI
+            # Rerun once to update UI
             st.experimental_rerun()
     else:
         st.info("No active chat. Please start a chat from the sidebar.")
 
-# Check if we need to refresh chat history
-if st.session_state.chat_thread_id and st.session_state.waiting_for_response:
-    try:
-        status_response = requests.get(
-            f"{GET_STATUS_URL}?chat_thread_id={st.session_state.chat_thread_id}"
-        )
-        
-        if status_response.status_code == 200:
-            status_data = status_response.json()
-            
-            # If processing is done, refresh the chat history
-            if not status_data.get("is_processing", False):
-                history_response = requests.get(
-                    f"{GET_HISTORY_URL}?chat_thread_id={st.session_state.chat_thread_id}"
-                )
-                
-                if history_response.status_code == 200:
-                    st.session_state.messages = history_response.json()["messages"]
-                    st.session_state.waiting_for_response = False
-                    
-                    # Rerun to update UI
-                    st.experimental_rerun()
-    except:
-        pass
-    
-    # Rerun every few seconds to check for updates
-    time.sleep(2)
-    st.experimental_rerun()
\ No newline at end of file